@@ -4,6 +4,8 @@
 
     Usage:
         autodoc.py <my_code.py>
+        autodoc.py --export <prompts.jsonl> <my_code.py>
+        autodoc.py --ingest <results.jsonl> <my_code.py>
 
     NOTE: This requires Python 3.9+ (this is openai's library requirement).
 
@@ -11,7 +13,17 @@
     The long-term plan is to add docstrings to the functions and classes in the
     file `my_code.py` provided on the command line.
 
-    Currently the modified file is printed to stdout.
+    By default the modified file is written to the output/ directory (or to
+    stdout). Set "output_mode" in config.json to "diff" or "edits" to write only
+    the docstring insertions, as a unified diff or as a JSON list of
+    [line_offset, text] edits. Set "apply_in_place" to true to overwrite the
+    input file with the updated code instead.
+
+    For bulk jobs, --export appends the prompts for my_code.py to prompts.jsonl
+    in the format of OpenAI's batch endpoint, without making any requests.
+    Once the batch has run, --ingest reads its results.jsonl and writes the
+    output for my_code.py as usual, using those results as the replies.
+
     This finds all function and method definitions in the input file and adds a
     docstring for them. This currently assumes there are no docstrings for such
     definitions. If there are already docstrings, then you will end up with the
@@ -43,13 +55,19 @@
 # Imports (OpenAI is imported only after all-systems-are-a-go farther below)
 
 # Standard library imports.
+import hashlib
 import json
 import os
+import queue
 import random
 import re
 import shutil
+import sqlite3
 import sys
+import threading
 import time
+import zlib
+from array import array
 from inspect import cleandoc
 from pathlib import Path
 
@@ -65,7 +83,81 @@ MAX_CODE_STR = 9000
 
 NUM_REPLY_TOKENS = 700
 
-output_file = None
+# This marks a diff line that has no newline at the end of the file.
+NO_NEWLINE_MARKER = '\\ No newline at end of file\n'
+
+# This is the model used for requests unless the model cascade picks another.
+DEFAULT_MODEL = 'text-davinci-003'
+
+# These are the keywords counted as branches when scoring the complexity of a
+# definition for the model cascade.
+BRANCH_RE = re.compile(r'\b(if|elif|for|while|try|except|with|and|or)\b')
+
+# These are the settings of the similarity index. Each definition is reduced
+# to shingles of SHINGLE_SIZE normalized tokens, and then to a MinHash signature
+# of NUM_MINHASHES values, which is split into NUM_BANDS bands for lookups.
+SHINGLE_SIZE   = 5
+NUM_MINHASHES  = 64
+NUM_BANDS      = 16
+MINHASH_PRIME  = (1 << 61) - 1
+STRING_RE      = re.compile(
+    r'""".*?"""|' r"'''.*?'''|" r'"[^"\n]*"|' r"'[^'\n]*'", re.DOTALL
+)
+
+# These are the fixed (a, b) pairs of the hash functions a * x + b used for the
+# MinHash signatures. They must not change, or old index entries won't match.
+_rng = random.Random(0)
+MINHASH_PARAMS = [
+    (_rng.randrange(1, MINHASH_PRIME), _rng.randrange(MINHASH_PRIME))
+    for _ in range(NUM_MINHASHES)
+]
+
+# When request hedging is on, we won't hedge until we've seen this many request
+# latencies, so that the percentile threshold is meaningful.
+HEDGE_MIN_SAMPLES = 5
+
+# These are the latencies, in seconds, of every completed request. They are
+# used to find the hedging threshold.
+request_latencies = []
+
+# These count requests for the hedging stats line.
+num_requests      = 0
+num_hedged        = 0
+num_hedge_wins    = 0
+
+# These are (signature, docstring) pairs for each documented function, used to
+# build the top-of-file docstring in "summary" mode.
+def_summaries = []
+
+# These track spending against the token budget and deadline. The token count
+# is an estimate for mocked calls.
+run_start         = time.time()
+tokens_used       = 0
+num_skipped       = 0
+tokens_lock       = threading.Lock()
+
+# These are used by bulk jobs. For --export, exported_ids holds the ids of the
+# requests already in the prompts file. For --ingest, bulk_results maps request
+# ids to the text of their replies.
+exported_ids      = set()
+bulk_results      = {}
+num_exported      = 0
+num_missing       = 0
+
+# This is the connection to the similarity index, when it's turned on.
+similarity_db     = None
+num_reused        = 0
+
+# This counts the docstrings written by local templates, without a request.
+num_templated     = 0
+
+# This maps each model cascade tier name to [num_definitions, total_seconds].
+tier_stats = {'simple': [0, 0.0], 'complex': [0, 0.0]}
+
+# These are the (line_offset, lines) insertions that add docstrings to the
+# input file, recorded by insert_lines() and applied by write_output() once the
+# whole file has been processed.
+insertions = []
 
 # Turn this on to have additional debug output written to a file.
 if True:
@@ -86,45 +178,212 @@ def pr(s=''):
 # ______________________________________________________________________
 # GPT functions
 
-def send_prompt_to_gpt(prompt):
+def request_completion(prompt, model):
+    """
+    This function makes a single completion request for the given prompt to the
+    given model and returns the text of the response. It also records the
+    request latency. If there's a deadline, the request times out when it is
+    reached, and this returns None.
+    """
+
+    start = time.time()
+
+    if MOCK_CALLS:
+        gpt_response = ('\nTHIS IS A MOCK DOCSTRING. To change this, ' +
+                        'set "mock_calls" to false in config.json.\n"""')
+    else:
+        timeout = None
+        if DEADLINE_SECONDS is not None:
+            timeout = max(DEADLINE_SECONDS - (time.time() - run_start), 0.1)
+
+        # Send request to GPT, return response
+        try:
+            response = openai.Completion.create(
+                model             = model,
+                prompt            = prompt,
+                temperature       = 0,
+                max_tokens        = NUM_REPLY_TOKENS,
+                top_p             = 1.0,
+                frequency_penalty = 0.0,
+                presence_penalty  = 0.0,
+                request_timeout   = timeout
+            )
+        except openai.error.Timeout:
+            pr('\nThe request timed out at the deadline.')
+            return None
+        gpt_response =  response['choices'][0]['text']
+
+    if MOCK_CALLS:
+        tokens = estimate_tokens(prompt) + estimate_tokens(gpt_response)
+    else:
+        tokens = response['usage']['total_tokens']
+    add_tokens_used(tokens)
+
+    request_latencies.append(time.time() - start)
+    return gpt_response
+
+
+def estimate_tokens(text):
+    """
+    This function returns a rough estimate of the number of tokens in text,
+    using the rule of thumb that a token is about four characters.
+    """
+    return len(text) // 4 + 1
+
+
+def add_tokens_used(tokens):
+    global tokens_used
+    with tokens_lock:
+        tokens_used += tokens
+
+
+def within_limits(prompt):
+    """
+    This function returns True if sending prompt is expected to stay within
+    both the token budget and the deadline. For the budget, we assume the reply
+    may use all NUM_REPLY_TOKENS. For the deadline, we assume the request takes
+    the median latency seen so far.
+    """
+    if MAX_TOKENS is not None:
+        if tokens_used + estimate_tokens(prompt) + NUM_REPLY_TOKENS > MAX_TOKENS:
+            return False
+    if DEADLINE_SECONDS is not None:
+        latencies = sorted(request_latencies)
+        expected = latencies[len(latencies) // 2] if latencies else 0
+        if time.time() - run_start + expected > DEADLINE_SECONDS:
+            return False
+    return True
+
+
+def def_priority(code_str, code):
+    """
+    This function returns a sort key for the function definition code_str
+    within the file contents code, so that definitions are documented in this
+    order: public before private, undocumented before documented, and then
+    most-referenced first.
+    """
+    m = re.match(r'\s*(?:async\s+)?def\s+(\w+)', code_str)
+    name = m.group(1) if m else ''
+    is_private = name.startswith('_') and not name.endswith('__')
+    has_docstring = bool(re.search(
+        r'\)\s*(->[^:]*)?:\s*\n\s*[rRuU]?(\"\"\"|\'\'\')', code_str
+    ))
+    num_refs = len(re.findall(rf'\b{re.escape(name)}\b', code)) - 1
+    return (is_private, has_docstring, -num_refs)
+
+
+def hedge_threshold():
+    """
+    This function returns the number of seconds after which a request should be
+    hedged, or None if we shouldn't hedge right now. We don't hedge until we
+    have enough latency samples, or once the hedged requests would exceed
+    HEDGE_MAX_EXTRA as a fraction of all requests.
+    """
+    if len(request_latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    if num_hedged + 1 > HEDGE_MAX_EXTRA * num_requests:
+        return None
+    latencies = sorted(request_latencies)
+    idx = round(HEDGE_PERCENTILE / 100 * (len(latencies) - 1))
+    return latencies[idx]
+
+
+def hedged_request(prompt, model):
+    """
+    This function makes a completion request for the given prompt. If the
+    request takes longer than hedge_threshold(), a duplicate request is sent,
+    and the response from whichever request finishes first is returned. The
+    slower request runs in a daemon thread and its response is discarded. Like
+    request_completion(), this returns None if the requests time out.
+    """
+    global num_hedged, num_hedge_wins
+
+    results = queue.Queue()
+
+    def start_request(is_hedge):
+        def run():
+            try:
+                results.put((is_hedge, request_completion(prompt, model), None))
+            except Exception as e:
+                results.put((is_hedge, None, e))
+        threading.Thread(target=run, daemon=True).start()
+
+    threshold = hedge_threshold()
+    start_request(is_hedge=False)
+    num_pending = 1
+
+    try:
+        result = results.get(timeout=threshold)
+    except queue.Empty:
+        if within_limits(prompt):
+            pr(f'Hedging a request that took over {threshold:.2f}s.')
+            num_hedged += 1
+            start_request(is_hedge=True)
+            num_pending += 1
+        result = results.get()
+
+    # If the first request to finish failed or timed out, fall back to the
+    # other one.
+    num_pending -= 1
+    if (result[1] is None or result[2]) and num_pending > 0:
+        result = results.get()
+
+    is_hedge, gpt_response, error = result
+    if error:
+        raise error
+    if is_hedge:
+        num_hedge_wins += 1
+    return gpt_response
+
+
+def send_prompt_to_gpt(prompt, model=DEFAULT_MODEL):
     """
     This function sends the provided prompt to GPT and returns GPT's response.
+    It returns None, without sending anything, if the request would go over the
+    token budget or the deadline. It also returns None if the request times out
+    at the deadline.
     """
+    global num_requests, num_skipped
 
     # Document what's happening to the debugger output file
     pr('\n' + ('_' * 70))
     pr('send_prompt()')
     pr(f'I will send over this prompt:\n\n')
     pr(prompt)
+    pr(f'\nUsing model {model}.')
 
-    if MOCK_CALLS:
-        gpt_response = ('\nTHIS IS A MOCK DOCSTRING. To change this, ' +
-                        'set "mock_calls" to false in config.json.\n"""')
+    if BULK_MODE:
+        return bulk_request(prompt, model)
+
+    if not within_limits(prompt):
+        pr('\nSkipping this request to stay within the budget and deadline.')
+        num_skipped += 1
+        return None
+
+    num_requests += 1
+    if HEDGE_REQUESTS:
+        gpt_response = hedged_request(prompt, model)
     else:
-        # Send request to GPT, return response
-        response = openai.Completion.create(
-            model             = 'text-davinci-003',
-            prompt            = prompt,
-            temperature       = 0,
-            max_tokens        = NUM_REPLY_TOKENS,
-            top_p             = 1.0,
-            frequency_penalty = 0.0,
-            presence_penalty  = 0.0
-        )
-        gpt_response =  response['choices'][0]['text']
+        gpt_response = request_completion(prompt, model)
+
+    # A request that timed out at the deadline counts as skipped.
+    if gpt_response is None:
+        num_requests -= 1
+        num_skipped += 1
+        return None
 
     return '"""' + gpt_response
 
 
-def fetch_docstring(code_str):
+def fetch_docstring(code_str, model=DEFAULT_MODEL):
 
     # Construct the GPT prompt
     prompt  = 'Write a docstring for the following code:\n\n'
     prompt += code_str[:MAX_CODE_STR]
     prompt += '\n\nDocstring:\n"""'
 
-    # Make the request for docstring to GPT
-    docstring = send_prompt_to_gpt(prompt)
+    # Make the request for docstring to GPT; this is None if it was skipped.
+    docstring = send_prompt_to_gpt(prompt, model)
 
     # Document what's happening to the debugger output file
     pr('Got the docstring:\n')
@@ -133,47 +392,585 @@ def fetch_docstring(code_str):
     # Return it
     return docstring
 
+
+def docstring_summary(docstring):
+    """
+    This function returns the first paragraph of a docstring as one line,
+    without the surrounding quotes.
+    """
+    text = docstring.strip().strip('"\'').strip()
+    return ' '.join(text.split('\n\n')[0].split())
+
+
+def fetch_module_docstring(code_str, model=DEFAULT_MODEL):
+    """
+    This function requests a top-of-file docstring built from the imports and
+    top-level names in code_str along with the summaries in def_summaries,
+    rather than from the code itself. This keeps the prompt small while still
+    covering the whole file.
+    """
+
+    lines = code_str.split('\n')
+    imports = [line for line in lines if re.match(r'(import|from)\s', line)]
+    names = []
+    for line in lines:
+        if m := re.match(r'(?:async\s+)?(?:def|class)\s+(\w+)', line):
+            names.append(m.group(1))
+        elif m := re.match(r'([A-Za-z_]\w*)\s*(:[^=]*)?=[^=]', line):
+            names.append(m.group(1))
+
+    # Construct the GPT prompt
+    prompt  = 'Write a docstring for a Python module with the following '
+    prompt += 'imports, top-level names, and function summaries.\n\n'
+    prompt += 'Imports:\n' + '\n'.join(imports) + '\n\n'
+    prompt += 'Top-level names: ' + ', '.join(dict.fromkeys(names)) + '\n\n'
+    prompt += 'Functions:\n'
+    for signature, docstring in def_summaries:
+        prompt += f'{signature}\n    {docstring_summary(docstring)}\n'
+    prompt  = prompt[:MAX_CODE_STR]
+    prompt += '\n\nDocstring:\n"""'
+
+    docstring = send_prompt_to_gpt(prompt, model)
+
+    # Document what's happening to the debugger output file
+    pr('Got the module docstring:\n')
+    pr(docstring)
+
+    return docstring
+
+
+# ______________________________________________________________________
+# Bulk job functions
+
+def bulk_request_id(prompt, model):
+    """
+    This function returns a stable id for a request, made of the input file
+    path and a hash of the model and prompt. The path is normalized, so that
+    ./my_code.py and my_code.py give the same id. Since the prompt contains
+    the code being documented, the id changes if that code changes.
+    """
+    path = os.path.relpath(os.path.abspath(input_filename_path))
+    digest = hashlib.sha1(f'{model}\n{prompt}'.encode()).hexdigest()[:16]
+    return f'{path}:{digest}'
+
+
+def bulk_request(prompt, model):
+    """
+    This function handles a request in a bulk job. For --export, it appends the
+    request to the prompts file and returns None. For --ingest, it returns the
+    reply from the results file, or None if there isn't one.
+    """
+    global num_exported, num_missing
+
+    request_id = bulk_request_id(prompt, model)
+
+    if BULK_MODE == 'export':
+        if request_id not in exported_ids:
+            exported_ids.add(request_id)
+            num_exported += 1
+            request = {
+                'custom_id': request_id,
+                'method': 'POST',
+                'url': '/v1/completions',
+                'body': {
+                    'model': model,
+                    'prompt': prompt,
+                    'temperature': 0,
+                    'max_tokens': NUM_REPLY_TOKENS,
+                    'top_p': 1.0,
+                    'frequency_penalty': 0.0,
+                    'presence_penalty': 0.0
+                }
+            }
+            bulk_file.write(json.dumps(request) + '\n')
+        return None
+
+    if request_id not in bulk_results:
+        pr(f'\nNo result found for {request_id}.')
+        num_missing += 1
+        return None
+    return '"""' + bulk_results[request_id]
+
+
+def load_exported_ids(path):
+    """
+    This function returns the set of request ids already in the prompts file at
+    path, or an empty set if there is no such file. Exporting skips these, as
+    the batch endpoint rejects duplicate ids.
+    """
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as f:
+        return {json.loads(line)['custom_id'] for line in f if line.strip()}
+
+
+def load_bulk_results(path):
+    """
+    This function reads a batch results file, with one JSON result per line,
+    and returns a dict mapping each successful request's id to its reply text.
+    """
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                continue
+            results[result['custom_id']] = response['body']['choices'][0]['text']
+    return results
+
+
+# ______________________________________________________________________
+# Similarity index functions
+
+def def_names(code_str):
+    """
+    This function returns the name of the function defined in code_str, along
+    with a list of its parameter names, leaving out self and cls.
+    """
+    m = re.match(r'\s*(?:async\s+)?def\s+(\w+)', code_str)
+    name = m.group(1) if m else ''
+    params = []
+    if m := re.search(r'\((.*?)\)\s*(->[^:]*)?:', code_str, re.DOTALL):
+        for param in m.group(1).split(','):
+            param = re.split(r'[:=]', param)[0].strip().lstrip('*')
+            if param and param not in ('self', 'cls', '/'):
+                params.append(param)
+    return name, params
+
+
+def shingles(code_str):
+    """
+    This function returns the set of token shingles for a function definition.
+    Before shingling, the function name, parameter names, local variable names,
+    strings, and numbers are replaced by placeholders. This way, definitions
+    that differ only in those names or constants get the same shingles.
+    """
+    name, params = def_names(code_str)
+    local_names = set(re.findall(r'\b([A-Za-z_]\w*)\s*=[^=]', code_str))
+    local_names |= {name, *params}
+
+    code_str = STRING_RE.sub(' STR ', code_str)
+    tokens = []
+    for token in re.findall(r'\w+|[^\w\s]', code_str):
+        if token in local_names:
+            token = 'ID'
+        elif token[0].isdigit():
+            token = 'NUM'
+        tokens.append(token)
+
+    n = SHINGLE_SIZE
+    return {' '.join(tokens[i:i + n]) for i in range(max(len(tokens) - n + 1, 1))}
+
+
+def minhash(code_str):
+    """
+    This function returns the MinHash signature of a function definition: a
+    list of NUM_MINHASHES values, each the minimum of one hash function over
+    the definition's shingles. The fraction of equal values in two signatures
+    estimates the Jaccard similarity of the two sets of shingles.
+    """
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingles(code_str)]
+    return [
+        min((a * h + b) % MINHASH_PRIME for h in hashes) & 0xffffffff
+        for a, b in MINHASH_PARAMS
+    ]
+
+
+def band_keys(signature):
+    """
+    This function returns one hash per band of the signature. Two definitions
+    are candidate near-duplicates if any of their band keys match.
+    """
+    rows = NUM_MINHASHES // NUM_BANDS
+    return [
+        zlib.crc32(array('Q', signature[i * rows:(i + 1) * rows]).tobytes())
+        for i in range(NUM_BANDS)
+    ]
+
+
+def open_similarity_index(path):
+    """
+    This function opens the similarity index database at path, creating its
+    tables if needed, and returns the connection.
+    """
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS defs (
+            id        INTEGER PRIMARY KEY,
+            signature BLOB,
+            name      TEXT,
+            params    TEXT,
+            docstring TEXT
+        );
+        CREATE TABLE IF NOT EXISTS bands (
+            band      INTEGER,
+            key       INTEGER,
+            def_id    INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS bands_idx ON bands (band, key);
+    ''')
+    return db
+
+
+def find_similar_docstring(code_str):
+    """
+    This function looks up the definition most similar to code_str in the
+    similarity index. If its estimated similarity is at least
+    SIMILARITY_THRESHOLD, this returns its docstring, with the old function and
+    parameter names replaced by the new ones. Otherwise it returns None.
+    Names are only replaced where they read as code -- inside backticks, before
+    a `(`, or after `self.` -- so that a param like `a` or `add` doesn't
+    rewrite the same word in the prose.
+    """
+    signature = minhash(code_str)
+
+    # Fetch every definition that shares a band key, in a single query.
+    keys = list(enumerate(band_keys(signature)))
+    where = ' OR '.join(['(bands.band = ? AND bands.key = ?)'] * len(keys))
+    rows = similarity_db.execute(
+        'SELECT DISTINCT defs.id, defs.signature, defs.name, defs.params, ' +
+        'defs.docstring FROM bands JOIN defs ON defs.id = bands.def_id ' +
+        f'WHERE {where}',
+        [value for band_key in keys for value in band_key]
+    )
+
+    best_score, best = 0, None
+    for def_id, blob, *entry in rows:
+        other = array('Q', blob)
+        score = sum(x == y for x, y in zip(signature, other)) / NUM_MINHASHES
+        if best is None or score > best_score:
+            best_score, best = score, entry
+
+    if best is None or best_score < SIMILARITY_THRESHOLD:
+        return None
+
+    old_name, old_params, docstring = best
+    pr(f'\nReusing the docstring of {old_name} (similarity {best_score:.2f}).')
+
+    # Adapt the docstring to the new names.
+    name, params = def_names(code_str)
+    old_params = json.loads(old_params)
+    renames = {old_name: name}
+    if len(params) == len(old_params):
+        renames.update(zip(old_params, params))
+    renames = {old: new for old, new in renames.items() if old and old != new}
+    if not renames:
+        return docstring
+    names = r'\b(' + '|'.join(map(re.escape, renames)) + r')\b'
+
+    def rename(m):
+        if m.group(1):
+            return re.sub(names, lambda n: renames[n.group(1)], m.group(1))
+        return renames[m.group(2) or m.group(3)]
+
+    pattern = rf'(`[^`\n]*`)|(?<=self\.){names}|{names}(?=\()'
+    return re.sub(pattern, rename, docstring)
+
+
+def add_to_similarity_index(code_str, docstring):
+    """
+    This function adds a function definition and its docstring to the
+    similarity index.
+    """
+    signature = minhash(code_str)
+    name, params = def_names(code_str)
+    cursor = similarity_db.execute(
+        'INSERT INTO defs (signature, name, params, docstring) VALUES (?, ?, ?, ?)',
+        (array('Q', signature).tobytes(), name, json.dumps(params), docstring)
+    )
+    similarity_db.executemany(
+        'INSERT INTO bands (band, key, def_id) VALUES (?, ?, ?)',
+        [(band, key, cursor.lastrowid)
+         for band, key in enumerate(band_keys(signature))]
+    )
+
+
+# ______________________________________________________________________
+# Local template functions
+
+def name_words(name):
+    """
+    This function turns an identifier like _get_time into words like get time.
+    """
+    return name.strip('_').replace('_', ' ')
+
+
+def word_list(words):
+    """
+    This function joins words into an English list, like "a, b, and c".
+    """
+    if len(words) <= 2:
+        return ' and '.join(words)
+    return ', '.join(words[:-1]) + ', and ' + words[-1]
+
+
+def template_docstring(code_str):
+    """
+    This function returns a docstring for a trivial function definition
+    without calling GPT, or None if the definition isn't one of these patterns:
+        - a pytest test_* function
+        - an __init__ that only sets attributes (and maybe calls super)
+        - a getter with no params whose body is just `return self.attr`
+        - a setter with one param whose body is just `self.attr = param`
+        - a wrapper with params whose body just returns another call with them
+    """
+    name, params = def_names(code_str)
+    m = re.search(r'\)\s*(->[^:]*)?:', code_str)
+    if not m:
+        return None
+    body = code_str[m.end():].split('\n')
+    stmts = [line.strip() for line in body]
+    stmts = [stmt for stmt in stmts if stmt and not stmt.startswith('#')]
+
+    text = None
+    if name.startswith('test_'):
+        text = f'Test {name_words(name[len("test_"):])}.'
+    elif name == '__init__' and stmts:
+        attrs = []
+        for stmt in stmts:
+            if m := re.fullmatch(r'self\.(\w+)\s*(:[^=]*)?=[^=].*', stmt):
+                attrs.append(name_words(m.group(1)))
+            elif not re.fullmatch(r'super\(\)\.__init__\(.*\)', stmt):
+                return None
+        if attrs:
+            noun = 'attribute' if len(attrs) == 1 else 'attributes'
+            text = f'Initialize the {word_list(attrs)} {noun}.'
+    elif len(stmts) == 1 and not params and (
+            m := re.fullmatch(r'return self\.(\w+)', stmts[0])):
+        text = f'Return the {name_words(m.group(1))}.'
+    elif len(stmts) == 1 and len(params) == 1 and (
+            m := re.fullmatch(rf'self\.(\w+) = {params[0]}', stmts[0])):
+        text = f'Set the {name_words(m.group(1))}.'
+    elif len(stmts) == 1 and params and (
+            m := re.fullmatch(r'return ([\w.]+)\((.*)\)', stmts[0])):
+        args = [arg.strip().lstrip('*') for arg in m.group(2).split(',')]
+        if [arg for arg in args if arg] == params:
+            text = f'Call {m.group(1)} with the given arguments and return ' + \
+                   'the result.'
+
+    if text is None:
+        return None
+    return '"""\n' + text + '\n"""'
+
+
+# ______________________________________________________________________
+# Model cascade functions
+
+def complexity_score(code_str):
+    """
+    This function returns a rough complexity score for a function definition,
+    given as a str. The score grows with the number of lines, branches,
+    parameters, and the depth of nesting.
+    """
+    lines = [line for line in code_str.split('\n') if line.strip()]
+    indents = [len(line) - len(line.lstrip()) for line in lines]
+    nesting = (max(indents) - indents[0]) // 4
+
+    num_params = 0
+    if m := re.search(r'\((.*?)\)\s*(->[^:]*)?:', code_str, re.DOTALL):
+        params = [p.strip() for p in m.group(1).split(',')]
+        params = [p for p in params if p and p not in ('self', 'cls', '*', '/')]
+        num_params = len(params)
+
+    num_branches = sum(len(BRANCH_RE.findall(line)) for line in lines[1:])
+
+    return len(lines) + 2 * num_branches + num_params + 2 * nesting
+
+
+def choose_tier(code_str):
+    """
+    This function returns the (tier_name, model) pair to use for documenting
+    the given function definition. Without the model cascade, every definition
+    goes to the complex tier.
+    """
+    if CASCADE_MODELS and complexity_score(code_str) <= COMPLEXITY_THRESHOLD:
+        return 'simple', SIMPLE_MODEL
+    return 'complex', COMPLEX_MODEL
+
+
 # ______________________________________________________________________
 # Print Functions
 
-def print_out(line):
+def insert_lines(line_offset, lines):
     """
-        This function prints the updated code in one of two ways:
-            - to a file in the output directory
-            - to console
+        This function records that lines are to be inserted before the 0-based
+        line line_offset of the input file. The recorded insertions are applied
+        by write_output() at the end of a run.
     """
-    if not PRINT_TO_CONSOLE:
-        output_file.write(line)
-        output_file.write('\n')
+    insertions.append((line_offset, lines))
+
+
+def apply_insertions(old_lines, insertions):
+    """
+        This function returns old_lines with each (line_offset, lines)
+        insertion added before the line at line_offset. Insertions at the same
+        offset keep their order.
+    """
+    new_lines = []
+    by_offset = sorted(insertions, key=lambda insertion: insertion[0])
+    i = 0
+    for line_offset, lines in by_offset:
+        new_lines.extend(old_lines[i:line_offset])
+        new_lines.extend(lines)
+        i = max(i, line_offset)
+    new_lines.extend(old_lines[i:])
+    return new_lines
+
+
+def insertion_edits(insertions):
+    """
+        This function returns the insertions as a list of [line_offset, text]
+        edits, sorted by line_offset, where each text ends with a newline.
+    """
+    by_offset = sorted(insertions, key=lambda insertion: insertion[0])
+    return [[line_offset, '\n'.join(lines) + '\n']
+            for line_offset, lines in by_offset]
+
+
+def insertion_diff(old_code, insertions, path, context=3):
+    """
+        This function returns a unified diff, with the given number of context
+        lines, that adds the insertions to old_code. Since every change is an
+        insertion, the hunks are built directly from the insertions.
+    """
+    old_lines = old_code.split('\n')
+    has_final_newline = old_lines[-1] == ''
+    if has_final_newline:
+        old_lines = old_lines[:-1]
+
+    # Group the insertions into hunks whose context lines would overlap.
+    hunks = []
+    for insertion in sorted(insertions, key=lambda insertion: insertion[0]):
+        if hunks and insertion[0] - hunks[-1][-1][0] <= 2 * context:
+            hunks[-1].append(insertion)
+        else:
+            hunks.append([insertion])
+
+    diff = [f'--- a/{path}\n', f'+++ b/{path}\n']
+    num_added = 0
+    for hunk in hunks:
+        start = max(hunk[0][0] - context, 0)
+        end   = min(hunk[-1][0] + context, len(old_lines))
+        body  = []
+        added = 0
+
+        # Inserting after a last line that has no newline gives that line one,
+        # so it shows up as removed and added back rather than as context.
+        eof_insert = not has_final_newline and hunk[-1][0] == len(old_lines)
+
+        for i in range(start, end + 1):
+            for line_offset, lines in hunk:
+                if line_offset == i:
+                    body.extend('+' + line + '\n' for line in lines)
+                    added += len(lines)
+            if i < end:
+                if eof_insert and i == len(old_lines) - 1:
+                    body.append('-' + old_lines[i] + '\n')
+                    body.append(NO_NEWLINE_MARKER)
+                    body.append('+' + old_lines[i] + '\n')
+                else:
+                    body.append(' ' + old_lines[i] + '\n')
+
+        # The marker goes after the last line of the hunk, whether that's a
+        # context line or an added line. If the last added line is empty, the
+        # new file does end with a newline, and that empty line isn't a line.
+        if not has_final_newline and end == len(old_lines):
+            if eof_insert and body[-1] == '+\n':
+                body.pop()
+                added -= 1
+            else:
+                body.append(NO_NEWLINE_MARKER)
+
+        old_start = start + 1 if end > start else start
+        new_start = start + num_added + 1
+        diff.append(f'@@ -{old_start},{end - start} ' +
+                    f'+{new_start},{end - start + added} @@\n')
+        diff.extend(body)
+        num_added += added
+
+    return ''.join(diff) if hunks else ''
+
+
+def write_output(input_path, output_path, old_code):
+    """
+        This function writes the updated code, with the recorded insertions,
+        according to the output mode:
+            - "file": the full updated file
+            - "diff": a unified diff against the input file
+            - "edits": a JSON list of [line_offset, text] insertions
+        It prints to the console if PRINT_TO_CONSOLE is set, and otherwise
+        writes to output_path. If APPLY_IN_PLACE is set, the input file itself
+        is overwritten with the updated code as well.
+    """
+    new_code = '\n'.join(apply_insertions(old_code.split('\n'), insertions))
+
+    if OUTPUT_MODE == 'diff':
+        text = insertion_diff(old_code, insertions, input_path)
+    elif OUTPUT_MODE == 'edits':
+        text = json.dumps(insertion_edits(insertions), indent=1) + '\n'
     else:
-        print(line)
+        text = new_code
 
+    if PRINT_TO_CONSOLE:
+        print(text, end='' if OUTPUT_MODE != 'file' else '\n')
+    elif not APPLY_IN_PLACE or OUTPUT_MODE != 'file':
+        with open(output_path, 'w') as f:
+            f.write(text)
 
-def print_fn_w_docstring(code_str):
-    """ 
+    if APPLY_IN_PLACE and new_code != old_code:
+        with open(input_path, 'w') as f:
+            f.write(new_code)
+
+
+def fetch_fn_docstring(code_str):
+    """
         This function requests GPT provide a docstring for the function code
-        (as a str) provided as an argument.  It then prints the function with
-        the docstring added.
+        (as a str) provided as an argument, using the model tier suited to the
+        definition. It returns None if the request was skipped.
     """
+    global num_reused, num_templated
+
+    if LOCAL_TEMPLATES:
+        if (docstring := template_docstring(code_str)) is not None:
+            num_templated += 1
+            return docstring
+
+    if similarity_db:
+        if (docstring := find_similar_docstring(code_str)) is not None:
+            num_reused += 1
+            return docstring
+
+    tier, model = choose_tier(code_str)
+    start = time.time()
+    docstring = fetch_docstring(code_str, model)
+    if docstring is not None:
+        tier_stats[tier][0] += 1
+        tier_stats[tier][1] += time.time() - start
+
+        # Mocked docstrings aren't worth reusing.
+        if similarity_db and not MOCK_CALLS:
+            add_to_similarity_index(code_str, docstring)
+    return docstring
 
-    # Fetch the docstring.
-    docstring = fetch_docstring(code_str)
 
-    # Print the function header/signature.
-    code_lines = code_str.split('\n')
-    print_out(code_lines[0])
+def insert_fn_docstring(code_str, docstring, line_offset):
+    """ 
+        This function records the insertion of the given docstring into the
+        function code (as a str) provided as an argument, which starts at the
+        0-based line line_offset of the input file. The docstring goes right
+        after the function header/signature.
+    """
 
-    # Print the docstring.
-    indent = re.search(r'^(\s*)', code_lines[0])
+    header = code_str.split('\n')[0]
+    indent = re.search(r'^(\s*)', header)
     indent = len(indent.group(1))
     prefix = ' ' * (indent + 4)
 
-    for ans_line in docstring.split('\n'):
-        print_out(prefix + ans_line)
-
-    # Print the rest of the function.
-    for line in code_lines[1:]:
-        print_out(line)
+    lines = [prefix + ans_line for ans_line in docstring.split('\n')]
+    insert_lines(line_offset + 1, lines)
 
 # This only prints messages to standard out if we aren't printing the modified
 # code output to the console.
@@ -195,8 +992,19 @@ if __name__ == '__main__':
     with keyfile.open() as f:
         config = json.load(f)
 
-    # Verify config.json contains a non-null definition for the API key.
-    if not ('api_key' in config and config['api_key']):
+    # See if this is an --export or --ingest run for a bulk job.
+    BULK_MODE = None
+    if len(sys.argv) > 1 and sys.argv[1] in ('--export', '--ingest'):
+        if len(sys.argv) < 4:
+            print(__doc__)
+            sys.exit(0)
+        BULK_MODE = sys.argv[1][2:]
+        bulk_path = sys.argv[2]
+        del sys.argv[1:3]
+
+    # Verify config.json contains a non-null definition for the API key. Bulk
+    # jobs don't make requests, so they don't need one.
+    if not BULK_MODE and not ('api_key' in config and config['api_key']):
         print(cleandoc('''
             Error: You're missing a openai API key in config.json.
             Please set {"api_key": "YOUR_API_KEY"} where YOUR_API_KEY is the
@@ -205,9 +1013,36 @@ if __name__ == '__main__':
         sys.exit(0)
 
     # Use the config data.
-    OPENAI_API_KEY = config['api_key']
+    OPENAI_API_KEY = config.get('api_key')
     PRINT_TO_CONSOLE = config['print_to_console'] if ('print_to_console' in config) else False
     MOCK_CALLS = config['mock_calls'] if ('mock_calls' in config) else False
+    OUTPUT_MODE = config.get('output_mode', 'file')
+    APPLY_IN_PLACE = config.get('apply_in_place', False)
+    HEDGE_REQUESTS = config.get('hedge_requests', False)
+    HEDGE_PERCENTILE = config.get('hedge_percentile', 95)
+    HEDGE_MAX_EXTRA = config.get('hedge_max_extra', 0.1)
+    CASCADE_MODELS = config.get('cascade_models', False)
+    SIMPLE_MODEL = config.get('simple_model', 'text-curie-001')
+    COMPLEX_MODEL = config.get('complex_model', DEFAULT_MODEL)
+    COMPLEXITY_THRESHOLD = config.get('complexity_threshold', 12)
+    TOF_DOCSTRING_MODE = config.get('tof_docstring_mode', 'code')
+    MAX_TOKENS = config.get('max_tokens', None)
+    DEADLINE_SECONDS = config.get('deadline_seconds', None)
+    LOCAL_TEMPLATES = config.get('local_templates', False)
+    SIMILARITY_REUSE = config.get('similarity_reuse', False)
+    SIMILARITY_THRESHOLD = config.get('similarity_threshold', 0.9)
+    SIMILARITY_INDEX_PATH = config.get('similarity_index_path', 'similarity_index.db')
+
+    if OUTPUT_MODE not in ('file', 'diff', 'edits'):
+        print(f'Error: Unknown output_mode "{OUTPUT_MODE}" in config.json.')
+        print('Please use one of "file", "diff", or "edits".')
+        sys.exit(0)
+
+    if TOF_DOCSTRING_MODE not in ('code', 'summary'):
+        print(f'Error: Unknown tof_docstring_mode "{TOF_DOCSTRING_MODE}" in ' +
+              'config.json.')
+        print('Please use one of "code" or "summary".')
+        sys.exit(0)
 
 
     # If this script has been improperly executed, print the docstring & exit.
@@ -218,14 +1053,30 @@ if __name__ == '__main__':
     # Open and ingest the Python file provided as an input.
     input_filename_path = sys.argv[1]
     input_filename = input_filename_path.split('/')[-1]
-    output_file_path = f'output/{input_filename}'
+    output_suffix = {'file': '', 'diff': '.diff', 'edits': '.edits.json'}
+    output_file_path = f'output/{input_filename}{output_suffix[OUTPUT_MODE]}'
+    if APPLY_IN_PLACE and OUTPUT_MODE == 'file':
+        output_file_path = input_filename_path
 
     with open(input_filename_path) as f:
         code = f.read()
     lines = code.split('\n')
 
+    if SIMILARITY_REUSE:
+        similarity_db = open_similarity_index(SIMILARITY_INDEX_PATH)
+
+    # Bulk jobs make no requests, so they don't need the openai library. Their
+    # top-of-file docstrings are written from the code, since a summary prompt
+    # can't be built until the function docstrings are known.
+    if BULK_MODE:
+        TOF_DOCSTRING_MODE = 'code'
+        if BULK_MODE == 'export':
+            exported_ids = load_exported_ids(bulk_path)
+            bulk_file = open(bulk_path, 'a')
+        else:
+            bulk_results = load_bulk_results(bulk_path)
     # If appropriate, inform the user that mock_calls is turned on
-    if MOCK_CALLS:
+    elif MOCK_CALLS:
         print_status_msg(cleandoc('''
             Note: Calls to GPT will be mocked. (To change this, open config.json
             and change "mock_calls" to false.)
@@ -238,40 +1089,28 @@ if __name__ == '__main__':
         print_status_msg('done!')
         openai.api_key = OPENAI_API_KEY
 
-    # If our output is going to a file, create and open a file in the output
-    # directory by the same name, for writing. 
+    # If our output is going to a file, ensure the output directory exists.
     if not PRINT_TO_CONSOLE:
-        # Ensure the output directory exists.
         Path('output').mkdir(exist_ok=True)
-        output_file = open(output_file_path, 'w')
 
     #######################################
     # BEGIN GENERATING CODE WITH DOCSTRINGS
     #######################################
 
-    # Get the 'Top of File' docstring.
-    print_status_msg('Writing top-of-file docstring .. ', end='', flush=True)
-    tof_docstring = fetch_docstring(code)
-    print_status_msg('done!')
-        
     # Print Out Input Code with Docstrings Inserted
-    #       Walk through the input code, line-by-line.
-    #       Add the top-of-file docstring.
-    #       Then print out code, until you find a function. 
-    #       When you find a function, capture it and have GPT provide a
-    #       docstring for it.
-    #       Print out the function with docstring.
-    #       Continue as before until file end.
-
-    # Print out any shebang line as a special case.
-    if lines[0].startswith('#!'):
-        print_out(lines[0])
-        lines = lines[1:]
-
-    # Print out the Top-of-File Docstring
-    print_out(tof_docstring)
-
-    # Set up vars for capturing functions    
+    #       Walk through the input code, line-by-line, splitting it into
+    #       function definitions and the lines between them.
+    #       Have GPT provide a docstring for each function, in priority order,
+    #       for as long as the budget and deadline allow.
+    #       Get the top-of-file docstring.
+    #       Print out the code, with the docstrings added.
+
+    # The top-of-file docstring goes after any shebang line, as a special case.
+    tof_offset = 1 if lines[0].startswith('#!') else 0
+
+    # Set up vars for capturing functions. Each function is recorded as a pair
+    # (line_offset, lines), where line_offset is the 0-based line of its header.
+    fns          = []
     capture_mode = False
     indentation  = 0
     current_fn   = None
@@ -281,22 +1120,16 @@ if __name__ == '__main__':
     def end_current_fn():
         if not capture_mode:
             return
-        print_fn_w_docstring('\n'.join(current_fn))
+        fns.append((fn_offset, current_fn))
 
-    status_prefix = 'Writing docstrings for each function .. '
-    for line_idx, line in enumerate(lines):
-
-        print_status_msg(
-                status_prefix + f'{line_idx+1} / {len(lines)}',
-                end='\r',
-                flush=True
-        )
+    for line_idx, line in enumerate(lines[tof_offset:], start=tof_offset):
 
         if m := re.search(r'^(\s*)def ', line):
             end_current_fn()
             capture_mode = True
             indentation  = len(m.group(1))
             current_fn   = [line]  # This will be a list of lines.
+            fn_offset    = line_idx
         else:
             this_indent = re.search(r'^(\s*)', line)
             this_indent = len(this_indent.group(1))
@@ -306,12 +1139,93 @@ if __name__ == '__main__':
                 capture_mode = False
             if capture_mode:
                 current_fn.append(line)
-            else:
-                print_out(line)
     end_current_fn()  # Don't drop a fn defined up to the last line.
 
+    # Fetch the docstrings, most important functions first.
+    fn_idxs = list(range(len(fns)))
+    fn_idxs.sort(key=lambda i: def_priority('\n'.join(fns[i][1]), code))
+    docstrings = {}
+
+    status_prefix = 'Writing docstrings for each function .. '
+    for num_done, fn_idx in enumerate(fn_idxs):
+
+        print_status_msg(
+                status_prefix + f'{num_done+1} / {len(fn_idxs)}',
+                end='\r',
+                flush=True
+        )
+        docstrings[fn_idx] = fetch_fn_docstring('\n'.join(fns[fn_idx][1]))
+
     print_status_msg(status_prefix + 'done!' + ' ' * 10)
-    print_status_msg(f'\nAll Done! Your updated code is at {output_file_path}')
 
-    if output_file:
-        output_file.close()
+    for fn_idx in sorted(docstrings):
+        if docstrings[fn_idx] is not None:
+            signature = fns[fn_idx][1][0].strip()
+            def_summaries.append((signature, docstrings[fn_idx]))
+
+    # Get the 'Top of File' docstring. This is the largest request, so it comes
+    # after the functions in priority order.
+    print_status_msg('Writing top-of-file docstring .. ', end='', flush=True)
+    if TOF_DOCSTRING_MODE == 'code':
+        tof_docstring = fetch_docstring(code, COMPLEX_MODEL)
+    else:
+        tof_docstring = fetch_module_docstring(code, COMPLEX_MODEL)
+    print_status_msg('done!')
+
+    if similarity_db:
+        similarity_db.commit()
+        similarity_db.close()
+
+    # An --export run only writes prompts, so it's done at this point.
+    if BULK_MODE == 'export':
+        bulk_file.close()
+        print_status_msg(f'\nExported {num_exported} prompts to {bulk_path}')
+        sys.exit(0)
+
+    if tof_docstring is not None:
+        insert_lines(tof_offset, tof_docstring.split('\n'))
+    for fn_idx, (fn_offset, fn_lines) in enumerate(fns):
+        if docstrings[fn_idx] is not None:
+            insert_fn_docstring('\n'.join(fn_lines), docstrings[fn_idx], fn_offset)
+
+    write_output(input_filename_path, output_file_path, code)
+
+    if HEDGE_REQUESTS:
+        print_status_msg(
+                f'Hedged {num_hedged} of {num_requests} requests; ' +
+                f'{num_hedge_wins} were won by the duplicate.'
+        )
+
+    if CASCADE_MODELS:
+        for tier, model in [('simple', SIMPLE_MODEL), ('complex', COMPLEX_MODEL)]:
+            num_defs, seconds = tier_stats[tier]
+            print_status_msg(
+                    f'Model tier {tier} ({model}): {num_defs} definitions ' +
+                    f'in {seconds:.1f}s.'
+            )
+
+    if LOCAL_TEMPLATES:
+        print_status_msg(
+                f'Wrote {num_templated} docstrings from local templates, ' +
+                f'saving {num_templated} requests.'
+        )
+
+    if SIMILARITY_REUSE:
+        print_status_msg(
+                f'Reused {num_reused} docstrings from near-duplicate ' +
+                'definitions.'
+        )
+
+    if num_missing > 0:
+        print_status_msg(
+                f'No result was found in {bulk_path} for {num_missing} ' +
+                'prompts; those docstrings were left out.'
+        )
+
+    if num_skipped > 0:
+        print_status_msg(
+                f'Skipped {num_skipped} of {num_requests + num_skipped} ' +
+                f'requests to stay within the budget and deadline (used ' +
+                f'~{tokens_used} tokens in {time.time() - run_start:.1f}s).'
+        )
+    print_status_msg(f'\nAll Done! Your updated code is at {output_file_path}')
@@ -0,0 +1,524 @@
+import json
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import autodoc
+
+
+# ______________________________________________________________________
+# Helpers
+
+def apply_diff(old_code, diff):
+    """
+    Apply a unified diff that only inserts lines to old_code, checking every
+    context line along the way.
+    """
+    old_lines = old_code.split('\n')
+    new_lines = []
+    i = 0
+    for line in diff.splitlines()[2:]:
+        if line.startswith('@@'):
+            start = int(line.split()[1][1:].split(',')[0])
+            start = max(start - 1, 0)
+            new_lines.extend(old_lines[i:start])
+            i = start
+        elif line.startswith('+'):
+            new_lines.append(line[1:])
+        elif line.startswith(' '):
+            assert old_lines[i] == line[1:]
+            new_lines.append(old_lines[i])
+            i += 1
+    new_lines.extend(old_lines[i:])
+    return '\n'.join(new_lines)
+
+
+class FakeTimeout(Exception):
+    pass
+
+
+def use_fake_openai(monkeypatch, *replies):
+    """
+    Replace the openai module with one whose n-th completion request sleeps for
+    replies[n][0] seconds and then returns the text replies[n][1], or raises it
+    if it's an exception. This returns the list of prompts sent so far.
+    """
+    prompts = []
+
+    def create(prompt, **kwargs):
+        delay, reply = replies[len(prompts)]
+        prompts.append(prompt)
+        time.sleep(delay)
+        if isinstance(reply, Exception):
+            raise reply
+        return {'choices': [{'text': reply}], 'usage': {'total_tokens': 10}}
+
+    monkeypatch.setattr(autodoc, 'openai', SimpleNamespace(
+        Completion=SimpleNamespace(create=create),
+        error=SimpleNamespace(Timeout=FakeTimeout)
+    ), raising=False)
+    for name, value in [('MOCK_CALLS', False), ('MAX_TOKENS', None),
+                        ('DEADLINE_SECONDS', None), ('HEDGE_PERCENTILE', 95),
+                        ('HEDGE_MAX_EXTRA', 0.1)]:
+        monkeypatch.setattr(autodoc, name, value, raising=False)
+    monkeypatch.setattr(autodoc, 'request_latencies', [])
+    monkeypatch.setattr(autodoc, 'num_requests', 10)
+    monkeypatch.setattr(autodoc, 'num_hedged', 0)
+    monkeypatch.setattr(autodoc, 'num_hedge_wins', 0)
+    monkeypatch.setattr(autodoc, 'tokens_used', 0)
+    return prompts
+
+
+# ______________________________________________________________________
+# Output modes
+
+def test_insertions_that_repeat_existing_lines():
+    # SequenceMatcher used to report non-insert edits for this input.
+    old_lines = ['B', 'B', 'B', 'B', 'A', 'C', 'C']
+    insertions = [(1, ['B']), (4, ['A', 'B']), (7, ['C'])]
+
+    new_lines = autodoc.apply_insertions(old_lines, insertions)
+    assert new_lines == ['B', 'B', 'B', 'B', 'B', 'A', 'B', 'A', 'C', 'C', 'C']
+    assert autodoc.insertion_edits(insertions) == [
+        [1, 'B\n'], [4, 'A\nB\n'], [7, 'C\n']
+    ]
+
+
+def test_insertion_edits_are_sorted_and_stable():
+    insertions = [(3, ['x']), (0, ['a']), (3, ['y'])]
+    assert autodoc.insertion_edits(insertions) == [
+        [0, 'a\n'], [3, 'x\n'], [3, 'y\n']
+    ]
+    assert autodoc.apply_insertions(['0', '1', '2', '3'], insertions) == [
+        'a', '0', '1', '2', 'x', 'y', '3'
+    ]
+
+
+def test_insertion_diff_applies_to_docstring_heavy_code():
+    old_code = '\n'.join([
+        'def f():',
+        '    """',
+        '    Old.',
+        '    """',
+        '',
+        '',
+        '',
+        '',
+        '',
+        '',
+        '',
+        'def g():',
+        '    return 1',
+        ''
+    ])
+    doc = ['    """', '    New.', '    """']
+    insertions = [(0, ['"""', 'Top.', '"""']), (1, doc), (12, doc)]
+
+    diff = autodoc.insertion_diff(old_code, insertions, 'x.py')
+    new_code = '\n'.join(
+        autodoc.apply_insertions(old_code.split('\n'), insertions)
+    )
+    assert diff.startswith('--- a/x.py\n+++ b/x.py\n@@ -1,4 +1,10 @@\n')
+    assert diff.count('@@ -') == 2
+    assert apply_diff(old_code, diff) == new_code
+
+
+def test_insertion_diff_without_final_newline():
+    old_code = 'def f():\n    return 1'
+
+    insertions = [(1, ['    """Doc."""'])]
+    diff = autodoc.insertion_diff(old_code, insertions, 'x.py')
+    assert diff.endswith('     return 1\n\\ No newline at end of file\n')
+
+    # Inserting at the very end gives the old last line a newline, and the
+    # marker moves to the new last line.
+    insertions = [(2, ['', 'def g():', '    pass'])]
+    diff = autodoc.insertion_diff(old_code, insertions, 'x.py')
+    assert diff == (
+        '--- a/x.py\n'
+        '+++ b/x.py\n'
+        '@@ -1,2 +1,5 @@\n'
+        ' def f():\n'
+        '-    return 1\n'
+        '\\ No newline at end of file\n'
+        '+    return 1\n'
+        '+\n'
+        '+def g():\n'
+        '+    pass\n'
+        '\\ No newline at end of file\n'
+    )
+
+
+# ______________________________________________________________________
+# Request hedging
+
+def test_no_hedge_before_min_samples(monkeypatch):
+    prompts = use_fake_openai(monkeypatch, (0.2, 'Slow."""'), (0, 'Hedge."""'))
+    autodoc.request_latencies[:] = [0.01] * (autodoc.HEDGE_MIN_SAMPLES - 1)
+
+    assert autodoc.hedge_threshold() is None
+    assert autodoc.hedged_request('prompt', 'model') == 'Slow."""'
+    assert len(prompts) == 1
+    assert autodoc.num_hedged == 0
+
+
+def test_hedge_wins_and_is_capped(monkeypatch):
+    prompts = use_fake_openai(monkeypatch, (0.5, 'Slow."""'), (0, 'Hedge."""'))
+    autodoc.request_latencies[:] = [0.01] * autodoc.HEDGE_MIN_SAMPLES
+
+    assert autodoc.hedge_threshold() == 0.01
+    assert autodoc.hedged_request('prompt', 'model') == 'Hedge."""'
+    assert prompts == ['prompt', 'prompt']
+    assert (autodoc.num_hedged, autodoc.num_hedge_wins) == (1, 1)
+
+    # With 10 requests and HEDGE_MAX_EXTRA = 0.1, a second hedge is over the
+    # cap until there are 20 requests.
+    assert autodoc.hedge_threshold() is None
+    monkeypatch.setattr(autodoc, 'num_requests', 20)
+    assert autodoc.hedge_threshold() is not None
+
+
+def test_hedge_is_used_when_first_reply_fails(monkeypatch):
+    for first_reply in [FakeTimeout(), RuntimeError('connection reset')]:
+        prompts = use_fake_openai(
+            monkeypatch, (0.2, first_reply), (0.3, 'Hedge."""')
+        )
+        autodoc.request_latencies[:] = [0.01] * autodoc.HEDGE_MIN_SAMPLES
+
+        assert autodoc.hedged_request('prompt', 'model') == 'Hedge."""'
+        assert len(prompts) == 2
+        assert autodoc.num_hedge_wins == 1
+
+
+# ______________________________________________________________________
+# Model cascade
+
+GETTER_FN = '''def get_name(self):
+    return self.name'''
+
+BRANCHY_FN = '''def parse(self, lines, strict=False):
+    result = []
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        try:
+            key, value = line.split('=')
+        except ValueError:
+            if strict:
+                raise
+        else:
+            result.append((key, value))
+    return result'''
+
+
+def use_cascade(monkeypatch, cascade_models):
+    for name, value in [('CASCADE_MODELS', cascade_models),
+                        ('SIMPLE_MODEL', 'simple-model'),
+                        ('COMPLEX_MODEL', 'complex-model'),
+                        ('COMPLEXITY_THRESHOLD', 12)]:
+        monkeypatch.setattr(autodoc, name, value, raising=False)
+
+
+def test_cascade_sends_by_complexity(monkeypatch):
+    use_cascade(monkeypatch, True)
+
+    assert autodoc.complexity_score(GETTER_FN) <= 12
+    assert autodoc.choose_tier(GETTER_FN) == ('simple', 'simple-model')
+    assert autodoc.complexity_score(BRANCHY_FN) > 12
+    assert autodoc.choose_tier(BRANCHY_FN) == ('complex', 'complex-model')
+
+
+def test_no_cascade_sends_all_to_complex_model(monkeypatch):
+    use_cascade(monkeypatch, False)
+
+    for code_str in [GETTER_FN, BRANCHY_FN]:
+        assert autodoc.choose_tier(code_str) == ('complex', 'complex-model')
+
+
+# ______________________________________________________________________
+# Summary mode
+
+MODULE_CODE = '''import os
+import sys
+from pathlib import Path
+
+VERSION = '1.0'
+cache: dict = {}
+
+
+class Store:
+    def load(self, path):
+        return Path(path).read_text()
+
+
+def main(argv):
+    if len(argv) > 1:
+        print(os.path.abspath(argv[1]))
+    sys.exit(0)
+'''
+
+
+def test_docstring_summary():
+    assert autodoc.docstring_summary(
+        '"""\n    Load the store\n    from disk.\n\n    Details.\n    """'
+    ) == 'Load the store from disk.'
+
+
+def test_module_prompt_uses_summaries_not_bodies(monkeypatch):
+    prompts = []
+    monkeypatch.setattr(autodoc, 'send_prompt_to_gpt',
+                        lambda prompt, model: prompts.append(prompt) or '"""')
+    monkeypatch.setattr(autodoc, 'def_summaries', [
+        ('def load(self, path):', '"""\nLoad the store from path.\n"""'),
+        ('def main(argv):', '"""\nPrint a path and exit.\n\nMore.\n"""'),
+    ])
+
+    autodoc.fetch_module_docstring(MODULE_CODE, 'model')
+    prompt, = prompts
+    for line in ['import os', 'import sys', 'from pathlib import Path']:
+        assert line in prompt
+    assert 'Top-level names: VERSION, cache, Store, main\n' in prompt
+    assert 'def load(self, path):\n    Load the store from path.\n' in prompt
+    assert 'def main(argv):\n    Print a path and exit.\n' in prompt
+    assert 'More.' not in prompt
+    for body_line in ['Path(path).read_text()', 'len(argv)', 'os.path.abspath',
+                      'sys.exit']:
+        assert body_line not in prompt
+
+
+# ______________________________________________________________________
+# Budget and deadline
+
+def use_limits(monkeypatch, max_tokens, deadline_seconds):
+    prompts = use_fake_openai(monkeypatch, *[(0, 'Doc."""')] * 10)
+    for name, value in [('MAX_TOKENS', max_tokens),
+                        ('DEADLINE_SECONDS', deadline_seconds),
+                        ('BULK_MODE', None), ('HEDGE_REQUESTS', False)]:
+        monkeypatch.setattr(autodoc, name, value, raising=False)
+    monkeypatch.setattr(autodoc, 'num_skipped', 0)
+    return prompts
+
+
+def test_budget_admits_only_some_prompts(monkeypatch):
+    # Each prompt is 101 tokens and needs room for all NUM_REPLY_TOKENS, but
+    # only uses 10, so the first two fit in the budget and the third doesn't.
+    prompts = use_limits(monkeypatch, 101 + autodoc.NUM_REPLY_TOKENS + 19, None)
+    prompt = 'x' * 400
+
+    replies = [autodoc.send_prompt_to_gpt(prompt) for _ in range(3)]
+    assert replies == ['"""Doc."""', '"""Doc."""', None]
+    assert len(prompts) == 2
+    assert autodoc.tokens_used == 20
+    assert autodoc.num_skipped == 1
+
+
+def test_deadline_already_passed(monkeypatch):
+    prompts = use_limits(monkeypatch, None, 5)
+    monkeypatch.setattr(autodoc, 'run_start', time.time() - 10)
+
+    assert not autodoc.within_limits('prompt')
+    assert autodoc.send_prompt_to_gpt('prompt') is None
+    assert prompts == []
+    assert autodoc.num_skipped == 1
+
+
+def test_def_priority_order():
+    code = '''
+def _helper():
+    pass
+
+def documented():
+    """
+    Docs.
+    """
+    return _helper()
+
+def rarely_used():
+    return 1
+
+def often_used():
+    return 2
+
+def main():
+    often_used()
+    often_used()
+    rarely_used()
+    documented()
+'''
+    defs = [d.strip() for d in code.split('\n\n')]
+    defs.sort(key=lambda d: autodoc.def_priority(d, code))
+    names = [autodoc.def_names(d)[0] for d in defs]
+    assert names == [
+        'often_used', 'rarely_used', 'main', 'documented', '_helper'
+    ]
+
+
+# ______________________________________________________________________
+# Bulk jobs
+
+def test_load_bulk_results_keeps_only_successes(tmp_path):
+    results_path = tmp_path / 'results.jsonl'
+    results = [
+        {'custom_id': 'a', 'error': None, 'response': {
+            'status_code': 200, 'body': {'choices': [{'text': 'Doc A."""'}]}}},
+        {'custom_id': 'b', 'error': {'message': 'failed'}, 'response': None},
+        {'custom_id': 'c', 'error': None, 'response': {
+            'status_code': 500, 'body': {}}},
+    ]
+    results_path.write_text('\n'.join(map(json.dumps, results)) + '\n\n')
+
+    assert autodoc.load_bulk_results(results_path) == {'a': 'Doc A."""'}
+
+
+def test_bulk_request_id_ignores_path_spelling(monkeypatch):
+    monkeypatch.setattr(autodoc, 'input_filename_path', './input/x.py',
+                        raising=False)
+    id_1 = autodoc.bulk_request_id('prompt', 'model')
+    monkeypatch.setattr(autodoc, 'input_filename_path', 'input/../input/x.py')
+    id_2 = autodoc.bulk_request_id('prompt', 'model')
+
+    assert id_1 == id_2
+    assert id_1.startswith('input/x.py:')
+    assert autodoc.bulk_request_id('other prompt', 'model') != id_1
+
+
+def test_export_then_ingest(tmp_path, monkeypatch):
+    prompts_path = tmp_path / 'prompts.jsonl'
+    monkeypatch.setattr(autodoc, 'input_filename_path', 'x.py', raising=False)
+    monkeypatch.setattr(autodoc, 'num_exported', 0)
+
+    # Exporting the same prompts twice writes each one once.
+    for _ in range(2):
+        monkeypatch.setattr(autodoc, 'BULK_MODE', 'export', raising=False)
+        monkeypatch.setattr(autodoc, 'exported_ids',
+                            autodoc.load_exported_ids(prompts_path))
+        with prompts_path.open('a') as bulk_file:
+            monkeypatch.setattr(autodoc, 'bulk_file', bulk_file, raising=False)
+            assert autodoc.bulk_request('prompt 1', 'model') is None
+            assert autodoc.bulk_request('prompt 2', 'model') is None
+
+    requests = [json.loads(line) for line in prompts_path.open()]
+    assert [r['body']['prompt'] for r in requests] == ['prompt 1', 'prompt 2']
+    assert autodoc.num_exported == 2
+
+    # Answer only the first prompt, then ingest.
+    results_path = tmp_path / 'results.jsonl'
+    results_path.write_text(json.dumps({
+        'custom_id': requests[0]['custom_id'],
+        'error': None,
+        'response': {'status_code': 200,
+                     'body': {'choices': [{'text': '\nDoc.\n"""'}]}}
+    }) + '\n')
+    monkeypatch.setattr(autodoc, 'BULK_MODE', 'ingest')
+    monkeypatch.setattr(autodoc, 'bulk_results',
+                        autodoc.load_bulk_results(results_path))
+    monkeypatch.setattr(autodoc, 'num_missing', 0)
+
+    assert autodoc.bulk_request('prompt 1', 'model') == '"""\nDoc.\n"""'
+    assert autodoc.bulk_request('prompt 2', 'model') is None
+    assert autodoc.num_missing == 1
+
+
+# ______________________________________________________________________
+# Similarity index
+
+WIDTH_FN = '''def get_width(self, widget, scale=2):
+    total = widget.size * scale + 10
+    return total'''
+
+HEIGHT_FN = '''def get_height(self, box, factor=3):
+    value = box.size * factor + 12
+    return value'''
+
+REMOVE_FN = '''def remove(self, path):
+    os.remove(path)
+    self.paths.discard(path)'''
+
+
+def use_similarity_index(monkeypatch, tmp_path, threshold):
+    db = autodoc.open_similarity_index(tmp_path / 'index.db')
+    monkeypatch.setattr(autodoc, 'similarity_db', db)
+    monkeypatch.setattr(autodoc, 'SIMILARITY_THRESHOLD', threshold,
+                        raising=False)
+    return db
+
+
+def test_minhash_ignores_names_and_constants():
+    assert autodoc.minhash(WIDTH_FN) == autodoc.minhash(HEIGHT_FN)
+    assert autodoc.minhash(WIDTH_FN) != autodoc.minhash(REMOVE_FN)
+    assert len(autodoc.minhash(WIDTH_FN)) == autodoc.NUM_MINHASHES
+
+
+def test_similar_docstring_is_adapted(monkeypatch, tmp_path):
+    use_similarity_index(monkeypatch, tmp_path, 0.9)
+    autodoc.add_to_similarity_index(
+        WIDTH_FN,
+        '"""\nReturn `widget.size` times `scale`, like self.get_width(widget).\n"""'
+    )
+
+    assert autodoc.find_similar_docstring(HEIGHT_FN) == (
+        '"""\nReturn `box.size` times `factor`, like self.get_height(widget).\n"""'
+    )
+    assert autodoc.find_similar_docstring(REMOVE_FN) is None
+
+
+def test_similar_docstring_keeps_prose(monkeypatch, tmp_path):
+    use_similarity_index(monkeypatch, tmp_path, 0.9)
+    autodoc.add_to_similarity_index(
+        'def add(a, b):\n    return a + 2 * b',
+        '"""\nReturn a value that is a plus twice b. '
+        'This is a helper to add numbers.\n"""'
+    )
+
+    assert autodoc.find_similar_docstring(
+        'def plus(x, y):\n    return x + 2 * y'
+    ) == (
+        '"""\nReturn a value that is a plus twice b. '
+        'This is a helper to add numbers.\n"""'
+    )
+
+
+def test_empty_index_with_zero_threshold(monkeypatch, tmp_path):
+    use_similarity_index(monkeypatch, tmp_path, 0)
+    assert autodoc.find_similar_docstring(WIDTH_FN) is None
+
+
+# ______________________________________________________________________
+# Local templates
+
+def test_template_docstrings():
+    cases = {
+        'def test_simple_animation():\n    assert run()':
+            'Test simple animation.',
+        'def __init__(self, *args) -> None:\n'
+        '    super().__init__(*args)\n'
+        '    self._time = 0.0\n'
+        '    self._frame_called = False':
+            'Initialize the time and frame called attributes.',
+        'def __init__(self, value):\n    self.value = value':
+            'Initialize the value attribute.',
+        'def _get_time(self):\n    return self._time':
+            'Return the time.',
+        'def set_width(self, width):\n    self.width = width':
+            'Set the width.',
+        'def run(self, *args, **kwargs):\n    return self.app.run(*args, **kwargs)':
+            'Call self.app.run with the given arguments and return the result.',
+    }
+    for code_str, text in cases.items():
+        assert autodoc.template_docstring(code_str) == f'"""\n{text}\n"""'
+
+
+def test_non_trivial_definitions_have_no_template():
+    for code_str in [
+        'def blend(self, other, factor):\n'
+        '    return Animatable(self.value + other.value * factor)',
+        'def __init__(self, path):\n    self.path = path\n    self.load()',
+        'def wrap(a, b):\n    return f(a, 1)',
+        'def get_x(self):\n    # Cached.\n    x = self.x\n    return x',
+        'def get(self, key):\n    return self.cache',
+        'def f():\n    return g()',
+    ]:
+        assert autodoc.template_docstring(code_str) is None